@@ -48,8 +48,8 @@ def _tanimoto_worker(k, fps):
     """Get per-fingerprint Tanimoto distance vector."""
     # pylint: disable=no-member
     sims = DataStructs.BulkTanimotoSimilarity(fps[k], fps[(k + 1):])
-    dists_k = [1. - s for s in sims]
-    return np.array(dists_k), 0
+    dists_k = 1. - np.asarray(sims)
+    return dists_k, 0
 
 def tanimoto_single(fp, fps):
     """
@@ -66,8 +66,8 @@ def tanimoto_single(fp, fps):
     """
     # pylint: disable=no-member
     sims = DataStructs.BulkTanimotoSimilarity(fp, fps)
-    dists = [1. - s for s in sims]
-    return np.array(dists), 0
+    dists = 1. - np.asarray(sims)
+    return dists, 0
 
 def tanimoto(fps1, fps2=None):
     """
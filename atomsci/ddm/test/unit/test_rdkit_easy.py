@@ -0,0 +1,358 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from rdkit import DataStructs
+from rdkit.ML.Cluster import Butina
+
+import atomsci.ddm.utils.rdkit_easy as rdke
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+delaney_file = os.path.join(test_dir, '..', 'test_datasets', 'delaney-processed_curated_fit.csv')
+
+
+def _bit_vector(on_bits, nbits=1024):
+    fp = DataStructs.ExplicitBitVect(nbits)
+    for i in on_bits:
+        fp.SetBit(i)
+    return fp
+
+
+def _boundary_pair():
+    """Two fingerprints with Tanimoto similarity 4/5, i.e. exactly at the default cutoff distance of 0.2"""
+    return [_bit_vector(range(50)), _bit_vector(range(40))]
+
+
+def _delaney_fingerprints(nrows=300):
+    df = pd.read_csv(delaney_file, nrows=nrows)
+    return [rdke._smiles_to_fingerprint(smi) for smi in df.rdkit_smiles.values]
+
+
+def _reference_distances(fps):
+    """Distance list built the way cluster_fingerprints originally built it"""
+    dists = []
+    for i in range(1, len(fps)):
+        sims = DataStructs.BulkTanimotoSimilarity(fps[i], fps[:i])
+        dists.extend([1-x for x in sims])
+    return dists
+
+
+def _reference_clusters(fps, cutoff):
+    return Butina.ClusterData(_reference_distances(fps), len(fps), cutoff, isDistData=True)
+
+
+def test_cluster_fingerprints_boundary_pair():
+    fps = _boundary_pair()
+    assert _reference_clusters(fps, 0.2) == ((1, 0),)
+    assert rdke.cluster_fingerprints(fps, cutoff=0.2) == ((1, 0),)
+
+
+@pytest.mark.parametrize('cutoff', [0.2, 0.4, 0.6])
+def test_cluster_fingerprints_matches_reference(cutoff):
+    fps = _delaney_fingerprints()
+    assert rdke.cluster_fingerprints(fps, cutoff=cutoff) == _reference_clusters(fps, cutoff)
+
+
+def test_tanimoto_distances_matches_reference():
+    fps = _delaney_fingerprints() + [_bit_vector([]), _bit_vector([])]
+    dists = rdke._tanimoto_distances(fps)
+    assert dists.dtype == np.float32
+    assert np.array_equal(dists, np.array(_reference_distances(fps), dtype=np.float32))
+
+
+def test_numba_kernel_is_opt_in(monkeypatch):
+    def fail(words):
+        raise AssertionError("Numba kernel used without use_numba=True")
+    monkeypatch.setattr(rdke, '_tanimoto_distances_numba', fail, raising=False)
+    fps = _delaney_fingerprints(50)
+    assert rdke.cluster_fingerprints(fps) == _reference_clusters(fps, 0.2)
+
+
+def _neighbor_lists_from_distances(dists, npts, cutoff):
+    """Neighbor lists, including each point itself, computed directly from a flattened distance list"""
+    nbr_lists = [[i] for i in range(npts)]
+    off = 0
+    for i in range(1, npts):
+        for j in range(i):
+            if dists[off+j] <= cutoff:
+                nbr_lists[i].append(j)
+                nbr_lists[j].append(i)
+        off += i
+    return [sorted(nbrs) for nbrs in nbr_lists]
+
+
+def _sparse_test_fingerprints():
+    return _delaney_fingerprints() + _boundary_pair() + [_bit_vector([]), _bit_vector([])]
+
+
+@pytest.mark.parametrize('cutoff', [0.0, 0.2, 0.4, 0.7, 1.0])
+def test_butina_from_neighbor_lists_matches_butina(cutoff):
+    fps = _sparse_test_fingerprints()
+    dists = _reference_distances(fps)
+    nbr_lists = _neighbor_lists_from_distances(dists, len(fps), cutoff)
+    expected = Butina.ClusterData(dists, len(fps), cutoff, isDistData=True)
+    assert rdke._butina_from_neighbor_lists(nbr_lists) == expected
+
+
+@pytest.mark.parametrize('cutoff', [0.0, 0.2, 0.4, 0.7, 1.0])
+def test_sparse_cluster_fingerprints_matches_reference(cutoff):
+    fps = _sparse_test_fingerprints()
+    assert rdke.cluster_fingerprints(fps, cutoff=cutoff, sparse=True) == _reference_clusters(fps, cutoff)
+
+
+def test_sparse_cluster_fingerprints_boundary_pair():
+    assert rdke.cluster_fingerprints(_boundary_pair(), cutoff=0.2, sparse=True) == ((1, 0),)
+
+
+@pytest.mark.skipif(not rdke.numba_supported, reason="numba is not installed")
+@pytest.mark.parametrize('nbits', [1024, 1000])
+def test_numba_distances_match_numpy_and_bulk_tanimoto(nbits):
+    rng = np.random.default_rng(0)
+    fps = [_bit_vector(np.flatnonzero(rng.random(nbits) < 0.05).tolist(), nbits) for i in range(200)]
+    fps += [_bit_vector([], nbits), _bit_vector([], nbits)]
+    packed = rdke._pack_fingerprints(fps)
+    numba_dists = rdke._tanimoto_distances_numba(rdke._to_uint64_words(packed))
+    expected = np.array(_reference_distances(fps), dtype=np.float32)
+    assert numba_dists.dtype == np.float32
+    assert np.array_equal(numba_dists, expected)
+    assert np.array_equal(numba_dists, rdke._bulk_tanimoto_distances(fps))
+    assert np.array_equal(numba_dists, rdke._tanimoto_distances(fps))
+    assert np.array_equal(numba_dists, rdke._tanimoto_distances(fps, use_numba=True))
+
+
+@pytest.mark.skipif(not rdke.numba_supported, reason="numba is not installed")
+def test_numba_cluster_fingerprints_matches_reference():
+    assert rdke.cluster_fingerprints(_boundary_pair(), cutoff=0.2, use_numba=True) == ((1, 0),)
+    fps = _delaney_fingerprints()
+    for cutoff in [0.2, 0.4]:
+        assert rdke.cluster_fingerprints(fps, cutoff=cutoff, use_numba=True) == _reference_clusters(fps, cutoff)
+
+
+def _sparse_bit_vector(on_bits, nbits=1024):
+    fp = DataStructs.SparseBitVect(nbits)
+    for i in on_bits:
+        fp.SetBit(i)
+    return fp
+
+
+def test_bulk_tanimoto_distances_boundary_pair():
+    fps = [_sparse_bit_vector(range(50)), _sparse_bit_vector(range(40))]
+    dists = rdke._bulk_tanimoto_distances(fps)
+    assert np.array_equal(dists, np.array(_reference_distances(_boundary_pair()), dtype=np.float32))
+    assert Butina.ClusterData(dists, 2, float(np.float32(0.2)), isDistData=True) == ((1, 0),)
+    # SparseBitVects can't be packed, so cluster_fingerprints computes their distances with the bulk builder
+    assert rdke.cluster_fingerprints(fps, cutoff=0.2) == ((1, 0),)
+
+
+def test_bulk_tanimoto_cluster_fingerprints_matches_reference():
+    fps = _delaney_fingerprints()
+    sparse_fps = [_sparse_bit_vector(list(fp.GetOnBits())) for fp in fps]
+    for cutoff in [0.2, 0.4]:
+        assert rdke.cluster_fingerprints(sparse_fps, cutoff=cutoff) == _reference_clusters(fps, cutoff)
+
+
+def test_sparse_cluster_fingerprints_sparse_bit_vects():
+    fps = [_sparse_bit_vector(range(50)), _sparse_bit_vector(range(40))]
+    assert rdke.cluster_fingerprints(fps, cutoff=0.2, sparse=True) == ((1, 0),)
+    fps = _sparse_test_fingerprints()
+    sparse_fps = [_sparse_bit_vector(list(fp.GetOnBits())) for fp in fps]
+    for cutoff in [0.2, 0.4, 1.0]:
+        assert rdke.cluster_fingerprints(sparse_fps, cutoff=cutoff, sparse=True) == _reference_clusters(fps, cutoff)
+
+
+class _EmulatedCuPy:
+    """
+    Minimal stand-in for the parts of CuPy used by _tanimoto_distances_gpu. The RawKernel runs the
+    tanimoto_tile kernel body on the CPU for every thread of the launch grid, so that the tiling and
+    offset arithmetic can be tested without a GPU.
+    """
+    float32 = np.float32
+    int32 = np.int32
+    empty = staticmethod(np.empty)
+    asnumpy = staticmethod(np.asarray)
+
+    def __init__(self):
+        self.launches = 0
+
+    @staticmethod
+    def asarray(a, dtype=None):
+        return np.asarray(a, dtype=dtype)
+
+    def RawKernel(self, source, name):
+        assert name == 'tanimoto_tile'
+
+        def launch(grid, block, args):
+            words, counts, nwords, row0, nrows, off0, out = args
+            self.launches += 1
+            popcount = rdke._POPCOUNT_TABLE
+            for r in range(grid[1]*block[1]):
+                if r >= nrows:
+                    continue
+                i = row0 + r
+                j = np.arange(min(i, grid[0]*block[0]))
+                common = popcount[np.bitwise_and(words[i], words[j]).view(np.uint8)].reshape(len(j), -1).sum(axis=1)
+                denom = counts[i] + counts[j] - common
+                sims = np.divide(common, denom, out=np.zeros(len(j)), where=denom > 0)
+                out[i*(i-1)//2 - off0 + j] = (1.0 - sims).astype(np.float32)
+        return launch
+
+
+@pytest.mark.parametrize('max_tile_entries', [1, 7, 100, 2**26])
+def test_gpu_distance_tiling(monkeypatch, max_tile_entries):
+    emulated_cp = _EmulatedCuPy()
+    monkeypatch.setattr(rdke, 'cp', emulated_cp, raising=False)
+    fps = _delaney_fingerprints(120) + _boundary_pair() + [_bit_vector([]), _bit_vector([])]
+    packed = rdke._pack_fingerprints(fps)
+    dists = rdke._tanimoto_distances_gpu(rdke._to_uint64_words(packed), rdke._popcount(packed),
+                                         max_tile_entries=max_tile_entries)
+    assert np.array_equal(dists, np.array(_reference_distances(fps), dtype=np.float32))
+    if max_tile_entries == 2**26:
+        assert emulated_cp.launches == 1
+    else:
+        assert emulated_cp.launches > 1
+
+
+def test_gpu_request_for_unpackable_fingerprints_warns(monkeypatch, caplog):
+    monkeypatch.setattr(rdke, 'cp', _EmulatedCuPy(), raising=False)
+    monkeypatch.setattr(rdke, 'cupy_supported', True)
+    fps = [_sparse_bit_vector(range(50)), _sparse_bit_vector(range(40))]
+    with caplog.at_level(logging.WARNING, logger='ATOM'):
+        assert rdke.cluster_fingerprints(fps, cutoff=0.2, use_gpu=True) == ((1, 0),)
+    assert 'BulkTanimotoSimilarity' in caplog.text
+
+
+def test_gpu_cluster_fingerprints_boundary_pair(monkeypatch):
+    monkeypatch.setattr(rdke, 'cp', _EmulatedCuPy(), raising=False)
+    monkeypatch.setattr(rdke, 'cupy_supported', True)
+    assert rdke.cluster_fingerprints(_boundary_pair(), cutoff=0.2, use_gpu=True) == ((1, 0),)
+
+
+def test_mol_to_html_svg_cache(tmp_path, monkeypatch):
+    from rdkit import Chem
+    from rdkit.Chem import AllChem
+    from base64 import b64decode
+
+    def embedded_svg(mol):
+        html = rdke.mol_to_html(mol, type='svg', embed=True)
+        return b64decode(html.split('base64,')[1].split("'")[0]).decode('utf-8')
+
+    rdke._cached_svg.cache_clear()
+    # not in canonical atom order, so redrawing from canonical SMILES would change the layout
+    plain = Chem.MolFromSmiles('OC(=O)c1ccccc1OC(C)=O')
+    assert embedded_svg(plain) == rdke.mol_to_svg(plain)
+    assert embedded_svg(Chem.Mol(plain)) == rdke.mol_to_svg(plain)
+    assert rdke._cached_svg.cache_info().hits == 1
+
+    # molecules with their own coordinates, explicit hydrogens or annotations must be drawn as they are
+    with_coords = Chem.Mol(plain)
+    AllChem.Compute2DCoords(with_coords)
+    conf = with_coords.GetConformer()
+    for i in range(with_coords.GetNumAtoms()):
+        pos = conf.GetAtomPosition(i)
+        conf.SetAtomPosition(i, (pos.y, pos.x, 0.0))
+    with_hs = Chem.AddHs(plain)
+    with_notes = Chem.Mol(plain)
+    with_notes.GetAtomWithIdx(0).SetProp('atomNote', 'acid O')
+    with_notes.GetBondWithIdx(0).SetProp('bondNote', 'b0')
+    for mol in [with_coords, with_hs, with_notes]:
+        assert embedded_svg(mol) == rdke.mol_to_svg(mol)
+        assert embedded_svg(mol) != embedded_svg(plain)
+
+    monkeypatch.chdir(tmp_path)
+    html = rdke.mol_to_html(with_coords, name='mol.svg', type='svg')
+    with open(os.path.join('rdkit_svg', 'mol.svg')) as fp:
+        assert fp.read() == rdke.mol_to_svg(with_coords)
+    assert 'rdkit_svg/mol.svg' in html
+
+    # the public save_svg always renders afresh
+    rdke._cached_svg.cache_clear()
+    rdke.save_svg(plain, 'plain.svg')
+    assert rdke._cached_svg.cache_info().currsize == 0
+    with open('plain.svg') as fp:
+        assert fp.read() == rdke.mol_to_svg(plain)
+
+
+def test_mol_to_html_recreates_removed_directory(tmp_path, monkeypatch):
+    import shutil
+    from rdkit import Chem
+
+    mol = Chem.MolFromSmiles('c1ccccc1O')
+    monkeypatch.chdir(tmp_path)
+    for img_type in ['svg', 'png']:
+        rdke.mol_to_html(mol, name=f'first.{img_type}', type=img_type)
+        shutil.rmtree('rdkit_svg')
+        rdke.mol_to_html(mol, name=f'second.{img_type}', type=img_type)
+        assert os.path.isfile(os.path.join('rdkit_svg', f'second.{img_type}'))
+
+    # the same relative directory name in a different working directory is a different directory
+    other_dir = tmp_path / 'other'
+    other_dir.mkdir()
+    monkeypatch.chdir(other_dir)
+    rdke.mol_to_html(mol, name='third.svg', type='svg')
+    assert os.path.isfile(os.path.join('rdkit_svg', 'third.svg'))
+
+
+def test_bitbirch_cluster_fingerprints_wrapper(monkeypatch):
+    """Checks how the BitBIRCH backend is called, using a stand-in for the bitbirch module"""
+    calls = []
+
+    class FakeBitBirch:
+        def __init__(self, threshold, branching_factor):
+            calls.append(('init', threshold, branching_factor))
+
+        def fit(self, X):
+            calls.append(('fit', X.dtype, X.shape))
+
+        def get_cluster_mol_ids(self):
+            return [[3], [0, 2, 4], [1, 5]]
+
+    class FakeBitBirchModule:
+        BitBirch = FakeBitBirch
+
+        @staticmethod
+        def set_merge(criterion):
+            calls.append(('set_merge', criterion))
+
+    monkeypatch.setattr(rdke, 'bb', FakeBitBirchModule, raising=False)
+    monkeypatch.setattr(rdke, 'bitbirch_supported', True)
+    fps = [_bit_vector([i, i + 1]) for i in range(6)]
+    assert rdke.cluster_fingerprints(fps, cutoff=0.35, bitbirch_threshold=5) == ((0, 2, 4), (1, 5), (3,))
+    assert calls == [('set_merge', 'diameter'), ('init', 0.65, 50), ('fit', np.uint8, (6, 1024))]
+    # below the threshold, Butina is used
+    calls.clear()
+    rdke.cluster_fingerprints(fps, cutoff=0.35, bitbirch_threshold=6)
+    assert calls == []
+
+
+@pytest.mark.parametrize('smiles', [np.nan, None, 'not_a_smiles'])
+def test_smiles_to_fingerprint_invalid(smiles):
+    with pytest.raises(ValueError, match='Invalid SMILES'):
+        rdke._smiles_to_fingerprint(smiles)
+
+
+def test_cluster_dataframe_from_smiles():
+    df = pd.read_csv(delaney_file, nrows=300)
+    rdke.add_mol_column(df, 'rdkit_smiles')
+    rdke.cluster_dataframe(df, cluster_column='mol_cluster')
+    rdke.cluster_dataframe(df, cluster_column='smiles_cluster', smiles_col='rdkit_smiles')
+    assert (df.mol_cluster >= 0).all()
+    assert (df.mol_cluster == df.smiles_cluster).all()
+
+
+def test_calculate_descriptors_matches_per_row_calculation():
+    from rdkit.Chem import Descriptors
+    from rdkit.ML.Descriptors import MoleculeDescriptors
+
+    df = pd.read_csv(delaney_file, nrows=20)[['rdkit_smiles']]
+    # a non-default index, so that positional and label-based assignment would differ
+    df.index = df.index * 3 + 7
+    rdke.add_mol_column(df, 'rdkit_smiles')
+    rdke.calculate_descriptors(df)
+
+    names = [x[0] for x in Descriptors._descList]
+    calculator = MoleculeDescriptors.MolecularDescriptorCalculator(names)
+    expected = np.array([calculator.CalcDescriptors(mol) for mol in df['mol'].values], dtype=np.float64)
+    np.testing.assert_array_equal(df[names].values, expected)
+    assert all(df[name].dtype == np.float64 for name in names)
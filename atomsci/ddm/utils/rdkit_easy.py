@@ -4,6 +4,7 @@ Utilities for clustering and visualizing compound structures using RDKit.
 # Mostly written by Logan Van Ravenswaay, with additions and edits by Ben Madej and Kevin McLoughlin.
 
 import os
+import functools
 
 from IPython.display import SVG, HTML, display
 from base64 import b64encode
@@ -11,16 +12,41 @@ import io
 
 import logging
 
+import numpy as np
 import pandas as pd
+from packaging import version
+import rdkit
 from rdkit import Chem
 from rdkit import DataStructs
-from rdkit.Chem import AllChem
 from rdkit.Chem import Descriptors
 from rdkit.Chem import PandasTools
+from rdkit.Chem import rdFingerprintGenerator
 from rdkit.Chem.Draw import MolToImage, rdMolDraw2D
 from rdkit.ML.Cluster import Butina
 from rdkit.ML.Descriptors import MoleculeDescriptors
 
+try:
+    from bitbirch import bitbirch as bb
+    bitbirch_supported = True
+except ImportError:
+    bitbirch_supported = False
+
+try:
+    import numba
+    numba_supported = True
+except ImportError:
+    numba_supported = False
+
+try:
+    import cupy as cp
+    cupy_supported = True
+except ImportError:
+    cupy_supported = False
+
+# Butina.ClusterData is NumPy-based from this release on, and takes a float32 distance array directly;
+# older releases index the distance data element by element and run faster on a plain list.
+butina_accepts_arrays = version.parse(rdkit.__version__) >= version.parse('2025.03.1')
+
 logging.basicConfig(format='%(asctime)-15s %(message)s')
 
 def setup_notebook():
@@ -56,6 +82,16 @@ def add_mol_column(df, smiles_col, molecule_col='mol'):
     return df
 
 
+@functools.lru_cache(maxsize=1)
+def _descriptor_calculator():
+    """
+    Returns the list of RDKit descriptor names and a calculator for them. The calculator is built
+    once and reused across calls to calculate_descriptors.
+    """
+    descriptors = [x[0] for x in Descriptors._descList]
+    return descriptors, MoleculeDescriptors.MolecularDescriptorCalculator(descriptors)
+
+
 def calculate_descriptors(df, molecule_column='mol'):
     """
     Uses RDKit to compute various descriptors for compounds specified by Mol objects in the given data frame.
@@ -70,17 +106,49 @@ def calculate_descriptors(df, molecule_column='mol'):
 
     """
 
-    descriptors = [x[0] for x in Descriptors._descList]
-    calculator = MoleculeDescriptors.MolecularDescriptorCalculator(descriptors)
-    for i in df.index:
-        cd = calculator.CalcDescriptors(df.at[i, molecule_column])
-        for desc, d in list(zip(descriptors, cd)):
-            df.at[i, desc] = d
+    descriptors, calculator = _descriptor_calculator()
+    # Compute all descriptor tuples first, then assign them to the data frame in one step. Collecting them
+    # in a float64 array keeps every descriptor column numeric, even when its first value is NaN.
+    rows = [calculator.CalcDescriptors(mol) for mol in df[molecule_column].values]
+    desc_arr = np.array(rows, dtype=np.float64).reshape(len(rows), len(descriptors))
+    df[descriptors] = desc_arr
+
+
+@functools.lru_cache(maxsize=1)
+def _morgan_generator():
+    """
+    Returns a Morgan fingerprint generator for the 1024-bit, radius 2 fingerprints used for clustering.
+    The generator is built once per process and reused for every molecule.
+    """
+    return rdFingerprintGenerator.GetMorganGenerator(radius=2, fpSize=1024)
+
+
+def _morgan_fingerprint(mol):
+    """
+    Computes the 1024-bit, radius 2 Morgan fingerprint used for clustering. Defined at module level
+    so that it can be mapped over a multiprocessing pool.
+    """
+    return _morgan_generator().GetFingerprint(mol)
+
+
+def _smiles_to_fingerprint(smiles):
+    """
+    Parses a SMILES string and computes its clustering fingerprint. Used in place of _morgan_fingerprint
+    when clustering from SMILES, so that only the SMILES strings and fingerprints are passed between processes.
+    """
+    if not isinstance(smiles, str):
+        # e.g. NaN or None for a missing value in a CSV file
+        raise ValueError(f"Invalid SMILES string: {smiles!r}")
+    mol = Chem.MolFromSmiles(smiles)
+    if mol is None:
+        raise ValueError(f"Invalid SMILES string: {smiles}")
+    return _morgan_fingerprint(mol)
 
 
-def cluster_dataframe(df, molecule_column='mol', cluster_column='cluster', cutoff=0.2):
+def cluster_dataframe(df, molecule_column='mol', cluster_column='cluster', cutoff=0.2, bitbirch_threshold=None,
+                      workers=1, sparse=False, smiles_col=None, use_gpu=False, use_numba=False):
     """
-    Performs Butina clustering on compounds specified by Mol objects in a data frame.
+    Performs Butina clustering on compounds specified by Mol objects or SMILES strings in a data frame.
 
     Modifies the input dataframe to add a column 'cluster_column' containing the cluster
     index for each molecule.
@@ -96,24 +164,53 @@ def cluster_dataframe(df, molecule_column='mol', cluster_column='cluster', cutof
 
         cutoff (float): Maximum Tanimoto distance parameter used by Butina algorithm to identify neighbors of each molecule.
 
+        bitbirch_threshold (int): If set, data frames with more compounds than this are clustered
+        with BitBIRCH instead of Butina. See cluster_fingerprints.
+
+        workers (int): Number of parallel processes to use for computing fingerprints. Workers are started
+        from a forkserver process, which costs a few seconds of startup, so this only pays off for data frames
+        with many thousands of compounds; for smaller sets, leave it at 1.
+
+        sparse (bool): If True, compute only the neighbor lists needed by Butina instead of the full
+        distance matrix. See cluster_fingerprints.
+
+        smiles_col (str): If given, name of a column of SMILES strings to compute fingerprints from, instead of
+        'molecule_column'. Mol objects are then created only transiently, so there is no need to call add_mol_column first.
+
+        use_gpu (bool): If True, compute the Tanimoto distance matrix on a CUDA GPU. See cluster_fingerprints.
+
+        use_numba (bool): If True, compute the Tanimoto distance matrix with a parallel Numba kernel.
+        See cluster_fingerprints.
+
     Returns:
         None. Input data frame will be modified in place.
 
     """
-    df[cluster_column] = -1
-    df2 = df.reset_index()
-    df2['df_index'] = df.index
-    mols = df2[[molecule_column]].values.tolist()
-    fingerprints = [AllChem.GetMorganFingerprintAsBitVect(x[0], 2, 1024) for x in mols]
-    clusters = cluster_fingerprints(fingerprints, cutoff=cutoff)
-    for i in range(len(clusters)):
-        c = clusters[i]
-        for j in c:
-            df_index = df2.at[j, 'df_index']
-            df.at[df_index, cluster_column] = i
-
-
-def cluster_fingerprints(fps, cutoff=0.2):
+    if smiles_col is not None:
+        fp_func = _smiles_to_fingerprint
+        inputs = df[smiles_col].tolist()
+    else:
+        fp_func = _morgan_fingerprint
+        inputs = df[molecule_column].to_numpy()
+    if workers > 1:
+        import multiprocessing
+        # Forking a process that has already run a parallel Numba kernel (use_numba=True) can deadlock the
+        # workers, so start them from a clean server process instead
+        with multiprocessing.get_context('forkserver').Pool(workers) as p:
+            fingerprints = p.map(fp_func, inputs, chunksize=200)
+    else:
+        fingerprints = [fp_func(x) for x in inputs]
+    clusters = cluster_fingerprints(fingerprints, cutoff=cutoff, bitbirch_threshold=bitbirch_threshold,
+                                    sparse=sparse, use_gpu=use_gpu, use_numba=use_numba)
+    # clusters hold row positions, so fill a positional array and assign it as a column in one step
+    cluster_arr = np.full(len(df), -1, dtype=int)
+    for i, c in enumerate(clusters):
+        cluster_arr[list(c)] = i
+    df[cluster_column] = cluster_arr
+
+
+def cluster_fingerprints(fps, cutoff=0.2, bitbirch_threshold=None, sparse=False, use_gpu=False,
+                         use_numba=False):
     """
     Performs Butina clustering on compounds specified by a list of fingerprint bit vectors.
 
@@ -124,22 +221,409 @@ def cluster_fingerprints(fps, cutoff=0.2):
 
         cutoff (float): Cutoff distance parameter used to seed clusters in Butina algorithm.
 
+        bitbirch_threshold (int): If set, and the bitbirch package is installed, fingerprint sets
+        larger than this are clustered with BitBIRCH, which avoids building the full O(N^2) distance
+        matrix. With its 'diameter' merge criterion, BitBIRCH adds a molecule to a cluster only if the
+        cluster's average pairwise Tanimoto similarity (iSIM) stays at least 1 - cutoff, so its clusters
+        are not the same as Butina's. If None, Butina is always used.
+
+        sparse (bool): If True, only the neighbor lists of pairs within 'cutoff' of each other are built,
+        so memory scales with the number of neighbors rather than N^2. Pairs whose bit counts alone rule
+        them out are never compared. The clusters are identical to those from the full distance matrix.
+
+        use_gpu (bool): If True, and CuPy is installed, the full distance matrix is computed on a CUDA GPU
+        in tiles of rows, each copied back to host memory as it is finished. Ignored if sparse is True.
+
+        use_numba (bool): If True, and numba is installed, the full distance matrix is computed by a parallel
+        Numba kernel. This is off by default: once Numba's thread pool has started, a later fork-based
+        multiprocessing pool in the same process can hang. Ignored if sparse or use_gpu is True.
+
     Returns:
         tuple of tuple: Indices of fingerprints assigned to each cluster.
 
     """
 
-    # first generate the distance matrix:
-    dists = []
     nfps = len(fps)
+    if bitbirch_threshold is not None and nfps > bitbirch_threshold:
+        if bitbirch_supported:
+            return _bitbirch_cluster_fingerprints(fps, cutoff)
+        logging.getLogger('ATOM').warning('bitbirch package is not installed; falling back to Butina clustering.')
+
+    if sparse:
+        return _butina_from_neighbor_lists(_tanimoto_neighbor_lists(fps, cutoff))
+
+    # first generate the lower triangle of the distance matrix:
+    dists = _tanimoto_distances(fps, use_gpu=use_gpu, use_numba=use_numba)
+
+    # now cluster the data; only convert to Python floats at the call boundary if this RDKit needs them.
+    # The distances are stored as float32, so compare them against the float32-rounded cutoff; otherwise a pair
+    # exactly at the cutoff (e.g. similarity 4/5 at cutoff 0.2) rounds up past it and is no longer a neighbor.
+    if not butina_accepts_arrays:
+        dists = dists.tolist()
+    cs = Butina.ClusterData(dists, nfps, float(np.float32(cutoff)), isDistData=True)
+    return cs
+
+
+def _fingerprints_to_array(fps):
+    """
+    Stacks a list of fingerprint bit vectors into a 2D array with one row of 0/1 bit values per fingerprint.
+
+    Args:
+        fps (list of rdkit.ExplicitBitVect): List of fingerprint bit vectors, all of the same length.
+
+    Returns:
+        np.ndarray: Array of shape (len(fps), nbits) and dtype uint8.
+
+    """
+    nbits = fps[0].GetNumBits() if len(fps) > 0 else 0
+    fp_array = np.zeros((len(fps), nbits), dtype=np.uint8)
+    # ConvertToNumpyArray resizes its target, so convert into a standalone buffer rather than a row view
+    bits = np.zeros((nbits,), dtype=np.uint8)
+    for i, fp in enumerate(fps):
+        DataStructs.ConvertToNumpyArray(fp, bits)
+        fp_array[i] = bits
+    return fp_array
+
+
+def _pack_fingerprints(fps):
+    """
+    Packs a list of fingerprint bit vectors into a contiguous 2D uint8 array, 8 bits per byte.
+
+    Args:
+        fps (list of rdkit.ExplicitBitVect): List of fingerprint bit vectors, all of the same length.
+
+    Returns:
+        np.ndarray: Array of shape (len(fps), ceil(nbits/8)) and dtype uint8.
+
+    """
+    return np.packbits(_fingerprints_to_array(fps), axis=1)
+
+
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def _popcount(packed):
+    """
+    Returns the number of set bits in each row of a packed uint8 bit array. Uses np.bitwise_count
+    (NumPy >= 2.0, which maps onto hardware popcount instructions) when available, otherwise a byte lookup table.
+    """
+    if hasattr(np, 'bitwise_count'):
+        counts = np.bitwise_count(packed)
+    else:
+        counts = _POPCOUNT_TABLE[packed]
+    return counts.sum(axis=-1, dtype=np.int32)
+
+
+def _tanimoto_distances(fps, use_gpu=False, use_numba=False):
+    """
+    Computes the lower triangle of the pairwise Tanimoto distance matrix for a list of fingerprints,
+    in the flattened row order expected by Butina.ClusterData with isDistData=True. ExplicitBitVects
+    of equal length are packed into a bit matrix and compared with vectorized popcounts; other
+    fingerprint types are compared with RDKit's BulkTanimotoSimilarity.
+
+    Args:
+        fps (list of rdkit.ExplicitBitVect): List of fingerprint bit vectors.
+
+        use_gpu (bool): If True, and CuPy is installed, compute packed fingerprint distances on the GPU.
+
+        use_numba (bool): If True, and numba is installed, compute packed fingerprint distances with the
+        parallel Numba kernel instead of NumPy.
+
+    Returns:
+        np.ndarray: float32 array of length N*(N-1)/2 containing the distances.
+
+    """
+    nfps = len(fps)
+    if nfps < 2:
+        return np.empty(0, dtype=np.float32)
+    if not _packable(fps):
+        # can't be packed into a single bit matrix, e.g. SparseBitVects
+        if use_gpu or use_numba:
+            logging.getLogger('ATOM').warning('Fingerprints are not ExplicitBitVects of a single length; '
+                                              'computing distances with BulkTanimotoSimilarity on the CPU.')
+        return _bulk_tanimoto_distances(fps)
+    packed = _pack_fingerprints(fps)
+    if use_gpu:
+        if cupy_supported:
+            return _tanimoto_distances_gpu(_to_uint64_words(packed), _popcount(packed))
+        logging.getLogger('ATOM').warning('cupy package is not installed; computing distances on the CPU.')
+    if use_numba:
+        if numba_supported:
+            return _tanimoto_distances_numba(_to_uint64_words(packed))
+        logging.getLogger('ATOM').warning('numba package is not installed; computing distances with NumPy.')
+    counts = _popcount(packed)
+    dists = np.empty(nfps*(nfps-1)//2, dtype=np.float32)
+    off = 0
     for i in range(1, nfps):
-        sims = DataStructs.BulkTanimotoSimilarity(fps[i], fps[:i])
-        dists.extend([1-x for x in sims])
+        common = _popcount(np.bitwise_and(packed[i], packed[:i]))
+        denom = counts[i] + counts[:i] - common
+        # RDKit defines the similarity of two empty fingerprints as 0
+        sims = np.divide(common, denom, out=np.zeros(i, dtype=np.float64), where=denom > 0)
+        dists[off:off+i] = 1.0 - sims
+        off += i
+    return dists
 
-    # now cluster the data:
-    cs = Butina.ClusterData(dists, nfps, cutoff, isDistData=True)
-    return cs
 
+def _packable(fps):
+    """
+    Returns True if the fingerprints are ExplicitBitVects of a single length, which can be packed into one
+    bit matrix by _pack_fingerprints.
+    """
+    return all(isinstance(fp, DataStructs.ExplicitBitVect) for fp in fps) and \
+        len(set(fp.GetNumBits() for fp in fps)) <= 1
+
+
+def _bulk_tanimoto_distances(fps):
+    """
+    Computes the flattened lower triangle of the Tanimoto distance matrix one row at a time with
+    RDKit's BulkTanimotoSimilarity, which computes the distances in C++ when returnDistance is set.
+
+    Args:
+        fps (list): List of RDKit fingerprints of any type supported by BulkTanimotoSimilarity.
+
+    Returns:
+        np.ndarray: float32 array of length N*(N-1)/2 containing the distances. As with the other distance
+        builders, these must be compared against a float32-rounded cutoff, as cluster_fingerprints does.
+
+    """
+    nfps = len(fps)
+    dists = np.empty(nfps*(nfps-1)//2, dtype=np.float32)
+    off = 0
+    for i in range(1, nfps):
+        dists[off:off+i] = DataStructs.BulkTanimotoSimilarity(fps[i], fps[:i], returnDistance=True)
+        off += i
+    return dists
+
+
+def _to_uint64_words(packed):
+    """
+    Reinterprets a packed uint8 fingerprint array as an array of 64-bit words, zero padding each row
+    to a multiple of 8 bytes.
+    """
+    nbytes = packed.shape[1]
+    padded_bytes = -(-nbytes // 8) * 8
+    if padded_bytes != nbytes:
+        packed = np.pad(packed, ((0, 0), (0, padded_bytes - nbytes)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+if numba_supported:
+    _M1 = np.uint64(0x5555555555555555)
+    _M2 = np.uint64(0x3333333333333333)
+    _M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+    _H01 = np.uint64(0x0101010101010101)
+
+    @numba.njit(cache=True)
+    def _popcount64(x):
+        """SWAR popcount of a 64-bit word; LLVM lowers this to a hardware POPCNT where available."""
+        x = x - ((x >> np.uint64(1)) & _M1)
+        x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+        x = (x + (x >> np.uint64(4))) & _M4
+        return (x * _H01) >> np.uint64(56)
+
+    @numba.njit(parallel=True, cache=True)
+    def _tanimoto_distances_numba(words):
+        """
+        Numba kernel computing the flattened lower triangle of the Tanimoto distance matrix from
+        fingerprints packed into rows of 64-bit words, parallelized over rows.
+        """
+        nfps, nwords = words.shape
+        counts = np.zeros(nfps, dtype=np.int64)
+        for i in numba.prange(nfps):
+            a = 0
+            for w in range(nwords):
+                a += _popcount64(words[i, w])
+            counts[i] = a
+        dists = np.empty(nfps*(nfps-1)//2, dtype=np.float32)
+        for i in numba.prange(1, nfps):
+            off = i*(i-1)//2
+            for j in range(i):
+                c = 0
+                for w in range(nwords):
+                    c += _popcount64(words[i, w] & words[j, w])
+                denom = counts[i] + counts[j] - c
+                # RDKit defines the similarity of two empty fingerprints as 0
+                sim = c / denom if denom > 0 else 0.0
+                dists[off+j] = 1.0 - sim
+        return dists
+
+
+_TANIMOTO_TILE_KERNEL = r'''
+extern "C" __global__
+void tanimoto_tile(const unsigned long long* words, const int* counts, const int nwords,
+                   const long long row0, const long long nrows, const long long off0, float* out) {
+    long long j = (long long)blockDim.x * blockIdx.x + threadIdx.x;
+    long long r = (long long)blockDim.y * blockIdx.y + threadIdx.y;
+    if (r >= nrows) return;
+    long long i = row0 + r;
+    if (j >= i) return;
+    int c = 0;
+    for (int w = 0; w < nwords; w++) {
+        c += __popcll(words[i*nwords + w] & words[j*nwords + w]);
+    }
+    int denom = counts[i] + counts[j] - c;
+    // RDKit defines the similarity of two empty fingerprints as 0
+    double sim = denom > 0 ? (double)c / denom : 0.0;
+    out[i*(i-1)/2 - off0 + j] = (float)(1.0 - sim);
+}
+'''
+
+def _tanimoto_distances_gpu(words, counts, max_tile_entries=2**26):
+    """
+    Computes the flattened lower triangle of the Tanimoto distance matrix on a CUDA GPU with CuPy.
+    Rows are processed in tiles holding at most max_tile_entries distances, so device memory use stays
+    bounded for large N; each tile is copied into the host array before the next one is computed.
+
+    Args:
+        words (np.ndarray): Fingerprints packed into rows of uint64 words, as returned by _to_uint64_words.
+
+        counts (np.ndarray): Number of bits set in each fingerprint.
+
+        max_tile_entries (int): Maximum number of distances computed per kernel launch.
+
+    Returns:
+        np.ndarray: float32 array of length N*(N-1)/2 containing the distances, to be compared against
+        a float32-rounded cutoff as in cluster_fingerprints.
+
+    """
+    nfps, nwords = words.shape
+    dists = np.empty(nfps*(nfps-1)//2, dtype=np.float32)
+    kernel = cp.RawKernel(_TANIMOTO_TILE_KERNEL, 'tanimoto_tile')
+    d_words = cp.asarray(words)
+    d_counts = cp.asarray(counts, dtype=cp.int32)
+    block = (32, 8)
+    row0 = 1
+    while row0 < nfps:
+        off0 = row0*(row0-1)//2
+        # last row whose distances still fit in the tile, i.e. the largest row1 with row1*(row1-1)/2 <= off0 + max
+        row1 = int((1 + np.sqrt(1 + 8*(off0 + max_tile_entries))) // 2)
+        row1 = min(nfps, max(row0 + 1, row1))
+        off1 = row1*(row1-1)//2
+        nrows = row1 - row0
+        d_out = cp.empty(off1 - off0, dtype=cp.float32)
+        grid = ((row1 + block[0] - 1) // block[0], (nrows + block[1] - 1) // block[1])
+        kernel(grid, block, (d_words, d_counts, np.int32(nwords), np.int64(row0), np.int64(nrows),
+                             np.int64(off0), d_out))
+        dists[off0:off1] = cp.asnumpy(d_out)
+        row0 = row1
+    return dists
+
+
+def _tanimoto_neighbor_lists(fps, cutoff=0.2):
+    """
+    Finds, for each fingerprint, the fingerprints within Tanimoto distance 'cutoff' of it, without
+    computing the full distance matrix. Since Tanimoto similarity is bounded above by
+    min(a, b)/max(a, b) for fingerprints with a and b bits set, fingerprints are processed in order of
+    bit count and each one is only compared to the following ones whose bit counts are within the bound.
+    Fingerprints that can't be packed into a single bit matrix, such as SparseBitVects, are compared with
+    BulkTanimotoSimilarity instead.
+
+    Args:
+        fps (list): List of RDKit fingerprints of any type supported by BulkTanimotoSimilarity.
+
+        cutoff (float): Maximum Tanimoto distance between neighbors.
+
+    Returns:
+        list of list of int: Sorted neighbor indices of each fingerprint, including the fingerprint itself.
+
+    """
+    nfps = len(fps)
+    nbr_lists = [[i] for i in range(nfps)]
+    if nfps < 2:
+        return nbr_lists
+    if _packable(fps):
+        packed = _pack_fingerprints(fps)
+        counts = _popcount(packed)
+    else:
+        packed = None
+        counts = np.array([fp.GetNumOnBits() for fp in fps], dtype=np.int64)
+    order = np.argsort(counts, kind='stable')
+    sorted_counts = counts[order]
+    min_sim = 1.0 - cutoff
+    for pos in range(nfps - 1):
+        i = order[pos]
+        if min_sim > 0:
+            # slightly widen the bound so that float rounding never drops a true neighbor
+            end = np.searchsorted(sorted_counts, counts[i] / min_sim * (1 + 1e-6), side='right')
+        else:
+            end = nfps
+        cand = order[pos+1:end]
+        if len(cand) == 0:
+            continue
+        if packed is not None:
+            common = _popcount(np.bitwise_and(packed[i], packed[cand]))
+            denom = counts[i] + counts[cand] - common
+            sims = np.divide(common, denom, out=np.zeros(len(cand), dtype=np.float64), where=denom > 0)
+            dists = (1.0 - sims).astype(np.float32)
+        else:
+            dists = np.array(DataStructs.BulkTanimotoSimilarity(fps[i], [fps[j] for j in cand],
+                                                                returnDistance=True), dtype=np.float32)
+        # compare in float32, against the float32-rounded cutoff, exactly as the dense path does
+        for j in cand[dists <= np.float32(cutoff)].tolist():
+            nbr_lists[i].append(j)
+            nbr_lists[j].append(i)
+    for nbrs in nbr_lists:
+        nbrs.sort()
+    return nbr_lists
+
+
+def _butina_from_neighbor_lists(nbr_lists):
+    """
+    Runs the Butina cluster assignment step given precomputed neighbor lists, following the same
+    centroid selection and tie-breaking order as Butina.ClusterData (without reordering).
+
+    Args:
+        nbr_lists (list of list of int): Sorted neighbor indices of each point, including the point itself.
+
+    Returns:
+        tuple of tuple: Indices of points assigned to each cluster; the first element of each cluster is its centroid.
+
+    """
+    candidates = sorted(((len(nbrs), idx) for idx, nbrs in enumerate(nbr_lists)), reverse=True)
+    seen = np.zeros(len(nbr_lists), dtype=bool)
+    clusters = []
+    for _, idx in candidates:
+        if seen[idx]:
+            continue
+        cluster = [idx]
+        seen[idx] = True
+        for nbr in nbr_lists[idx]:
+            if not seen[nbr]:
+                cluster.append(nbr)
+                seen[nbr] = True
+        clusters.append(tuple(cluster))
+    return tuple(clusters)
+
+
+def _bitbirch_cluster_fingerprints(fps, cutoff=0.2):
+    """
+    Clusters fingerprints with the BitBIRCH algorithm, using a Tanimoto similarity threshold of 1 - cutoff.
+    Written against the bitbirch module from the mqcomplab/bitbirch repository, whose documented usage
+    selects the merge criterion with set_merge() before constructing BitBirch.
+
+    Args:
+        fps (list of rdkit.ExplicitBitVect): List of fingerprint bit vectors.
+
+        cutoff (float): With the 'diameter' merge criterion, BitBIRCH merges a molecule into a cluster
+        only if the cluster's average pairwise Tanimoto similarity (iSIM) including it is at least
+        1 - cutoff; individual pairs of members may still be further than 'cutoff' apart.
+
+    Returns:
+        tuple of tuple: Indices of fingerprints assigned to each cluster, largest clusters first,
+        matching the ordering of Butina.ClusterData.
+
+    """
+    # 0/1 bits as uint8 take one byte per bit, rather than eight for int64
+    fp_array = _fingerprints_to_array(fps)
+    bb.set_merge('diameter')
+    brc = bb.BitBirch(threshold=1.0 - cutoff, branching_factor=50)
+    brc.fit(fp_array)
+    clusters = sorted(brc.get_cluster_mol_ids(), key=len, reverse=True)
+    return tuple(tuple(int(i) for i in c) for c in clusters)
+
+
+# (working directory, directory) pairs of image directories already created by mol_to_html, so that repeated
+# calls over a data frame skip os.makedirs; relative directories are distinguished by the working directory
+_dirs_created = set()
 
 def mol_to_html(mol, name='', type='svg', directory='rdkit_svg', embed=False, width=400, height=200):
     """
@@ -173,23 +657,26 @@ def mol_to_html(mol, name='', type='svg', directory='rdkit_svg', embed=False, wi
     if embed:
         log.info("Warning: embed=True will result in large data structures if you have a lot of molecules.")
         if type.lower() == 'png':
-            img=mol_to_pil(mol, size=(width,height))
-            imgByteArr = io.BytesIO()
-            img.save(imgByteArr, format=img.format)
-            imgByteArr = imgByteArr.getvalue()
-            data_url = f'data:image/png;base64,' + b64encode(imgByteArr).decode()
+            img=mol_to_png(mol, size=(width,height))
+            data_url = f'data:image/png;base64,' + b64encode(img).decode()
         elif type.lower() == 'svg':
-            img=mol_to_svg(mol, size=(width,height)).encode('utf-8')
+            img=_mol_to_svg_cached(mol, size=(width,height)).encode('utf-8')
             data_url = f'data:image/svg+xml;base64,' + b64encode(img).decode()
         return f"<img src='{data_url}' style='width:{width}px;'>" 
     
     else:
-        img_file = '%s/%s' % (directory, name)
-        os.makedirs(directory, exist_ok=True)
-        if type.lower() == 'png':
-            save_png(mol, img_file, size=(width,height))
-        elif type.lower()=='svg':
-            save_svg(mol, img_file, size=(width,height))
+        img_file = os.path.join(directory, name)
+        save_func = save_png if type.lower() == 'png' else _save_svg_cached
+        dir_key = (os.getcwd(), directory)
+        if dir_key not in _dirs_created:
+            os.makedirs(directory, exist_ok=True)
+            _dirs_created.add(dir_key)
+        try:
+            save_func(mol, img_file, size=(width,height))
+        except FileNotFoundError:
+            # the directory was removed after we first created it
+            os.makedirs(directory, exist_ok=True)
+            save_func(mol, img_file, size=(width,height))
         return f"<img src='{img_file}' style='width:{width}px;'>"
 
 def mol_to_pil(mol, size=(400, 200)):
@@ -226,6 +713,50 @@ def save_png(mol, name, size=(400, 200)):
     pil.save(name, 'PNG')
 
 
+def _prepare_mol_for_drawing(mol):
+    """
+    Returns a copy of mol prepared for drawing with rdMolDraw2D, tolerating molecules with
+    uncomputed valences or kekulization failures.
+    """
+    # Cheap for molecules whose valences are already computed, and avoids raising and catching a
+    # RuntimeError for those that aren't (e.g. unsanitized or empty molecules)
+    mol.UpdatePropertyCache(strict=False)
+    try:
+        mc_mol = rdMolDraw2D.PrepareMolForDrawing(mol, kekulize=True)
+    except ValueError:
+        # can happen on a kekulization failure
+        mc_mol = rdMolDraw2D.PrepareMolForDrawing(mol, kekulize=False)
+    return mc_mol
+
+
+def mol_to_png(mol, size=(400, 200)):
+    """
+    Returns PNG image data for the given molecule's structure, rendered directly by RDKit's Cairo drawer.
+    Falls back to rendering through PIL if this RDKit build lacks Cairo support.
+
+    Args:
+        mol (rdkit.Chem.Mol): Object representing molecule.
+
+        size (tuple): Width and height of bounding box of image.
+
+    Returns:
+        bytes: PNG-encoded image of the molecule's structure.
+
+    """
+    if not hasattr(rdMolDraw2D, 'MolDraw2DCairo'):
+        img = mol_to_pil(mol, size=size)
+        imgByteArr = io.BytesIO()
+        img.save(imgByteArr, format='PNG')
+        return imgByteArr.getvalue()
+    img_wd, img_ht = size
+    mc_mol = _prepare_mol_for_drawing(mol)
+    drawer = rdMolDraw2D.MolDraw2DCairo(img_wd, img_ht)
+    drawer.drawOptions().prepareMolsBeforeDrawing = False
+    drawer.DrawMolecule(mc_mol)
+    drawer.FinishDrawing()
+    return drawer.GetDrawingText()
+
+
 def mol_to_svg(mol, size=(400,200)):
     """
     Returns a RDKit MolDraw2DSVG object containing an image of the given molecule's structure.
@@ -240,24 +771,40 @@ def mol_to_svg(mol, size=(400,200)):
 
     """
     img_wd, img_ht = size
-    try:
-        mol.GetAtomWithIdx(0).GetExplicitValence()
-    except RuntimeError:
-        mol.UpdatePropertyCache(False)
-    try:
-        mc_mol = rdMolDraw2D.PrepareMolForDrawing(mol, kekulize=True)
-    except ValueError:
-        # can happen on a kekulization failure
-        mc_mol = rdMolDraw2D.PrepareMolForDrawing(mol, kekulize=False)
+    mc_mol = _prepare_mol_for_drawing(mol)
     drawer = rdMolDraw2D.MolDraw2DSVG(img_wd, img_ht)
+    # mc_mol has already been prepared, so don't let the drawer prepare a second copy
+    drawer.drawOptions().prepareMolsBeforeDrawing = False
     drawer.DrawMolecule(mc_mol)
     drawer.FinishDrawing()
     svg = drawer.GetDrawingText()
-    svg = svg.replace('svg:','')
-    svg = svg.replace('xmlns:svg','xmlns')
+    # Older RDKit releases prefix every element with an svg: namespace; newer ones don't, so only
+    # scan and rewrite the whole text when the opening tag shows the prefix is there.
+    if '<svg:svg' in svg[:200]:
+        svg = svg.replace('svg:','')
+        svg = svg.replace('xmlns:svg','xmlns')
     return svg
 
 
+@functools.lru_cache(maxsize=4096)
+def _cached_svg(mol_binary, width, height):
+    """
+    Returns the SVG text for the molecule serialized in mol_binary, so that data frames containing the
+    same molecule in many rows only render it once.
+    """
+    return mol_to_svg(Chem.Mol(mol_binary), size=(width, height))
+
+
+def _mol_to_svg_cached(mol, size=(400,200)):
+    """
+    Returns the same SVG text as mol_to_svg, reusing a cached rendering for molecules seen before. The cache
+    is keyed by the molecule's binary serialization including all properties, which keeps its atom order,
+    conformers, explicit hydrogens and any atom or bond notes and labels, so a cache hit draws exactly
+    what mol_to_svg would.
+    """
+    return _cached_svg(mol.ToBinary(Chem.PropertyPickleOptions.AllProps), size[0], size[1])
+
+
 def save_svg(mol, name, size=(400,200)):
     """
     Draws the molecule mol into an SVG file with filename 'name' and with the given size
@@ -271,7 +818,20 @@ def save_svg(mol, name, size=(400,200)):
         size (tuple): Width and height of bounding box of image.
 
     """
-    svg = mol_to_svg(mol, size)
+    _write_svg(mol_to_svg(mol, size), name)
+
+
+def _save_svg_cached(mol, name, size=(400,200)):
+    """
+    Same as save_svg, but reuses a cached rendering for molecules seen before; see _mol_to_svg_cached.
+    """
+    _write_svg(_mol_to_svg_cached(mol, size), name)
+
+
+def _write_svg(svg, name):
+    """
+    Writes the SVG text svg to the file with filename 'name'.
+    """
     with open(name, 'w') as img_out:
         img_out.write(svg)
 